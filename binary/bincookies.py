@@ -6,6 +6,18 @@
 
 import datetime, struct, time
 
+# If the cookies module is available, parsed cookies are returned as its
+# compact Cookie records; otherwise they are plain dictionaries.
+try:
+    from cookies import Cookie
+except ImportError:
+    Cookie = dict
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
 # With MacOS "Lion", Apple switched from using a plist file to store cookies
 # for Safari to a new "binary cookies" file format.  Based on a description of
 # the format from E. Miyake, the following parser unpacks it.
@@ -59,7 +71,7 @@ class error(Exception):
 mac_abs_epoch = 978336000
 
 # This is the magic header stored at the beginning of a bincookie file.
-FILE_MAGIC = 'cook'
+FILE_MAGIC = b'cook'
 
 # This is the magic header stored at the beginning of a page.
 PAGE_MAGIC = 256
@@ -162,7 +174,7 @@ def phead(data, pos):
     for i in xrange(len(xs)):
         xs[i], pos = lsize(data, pos)
     if xs[-1] != 0:
-        raise error("incorrect page sentinel: %s" % ck)
+        raise error("incorrect page sentinel: %s" % xs[-1])
 
     return xs, pos
 
@@ -180,14 +192,14 @@ def cookie(data, pos=0, size=0):
     _, pos = bytes(data, pos, 8)  # skip padding
     exp, pos = dstamp(data, pos)
     cre, pos = dstamp(data, pos)
-    return {
-        'Domain': zstr(data, urlpos + base),
-        'Name': zstr(data, namepos + base),
-        'Path': zstr(data, pathpos + base),
-        'Value': zstr(data, valpos + base),
+    return Cookie({
+        'Domain': text(zstr(data, urlpos + base)),
+        'Name': text(zstr(data, namepos + base)),
+        'Path': text(zstr(data, pathpos + base)),
+        'Value': text(zstr(data, valpos + base)),
         'Created': cre,
         'Expires': exp,
-    }
+    })
 
 
 def u_cookie(ck):
@@ -204,12 +216,12 @@ def u_cookie(ck):
     size = head + len(host) + len(name) + len(path) + len(val)
     pkt = [
         u_lsize(size),
-        u_bytes('\x00', 12),
+        u_bytes(b'\x00', 12),
         u_lsize(p_host),
         u_lsize(p_name),
         u_lsize(p_path),
         u_lsize(p_val),
-        u_bytes('\x00', 8),
+        u_bytes(b'\x00', 8),
         u_dstamp(ck['Expires']),
         u_dstamp(ck['Created']),
         u_zstr(ck['Domain']),
@@ -217,7 +229,7 @@ def u_cookie(ck):
         u_zstr(ck['Path']),
         u_zstr(ck['Value']),
     ]
-    return ''.join(pkt)
+    return b''.join(pkt)
 
 
 def bsize(data, pos):
@@ -276,17 +288,26 @@ def u_dstamp(dt):
 
 def zstr(data, pos):
     """Return a zero-terminated string starting at pos."""
-    start = pos
-    while pos < len(data) and data[pos] != '\x00':
-        pos += 1
-    return data[start:pos]
+    end = data.find(b'\x00', pos)
+    if end < 0:
+        end = len(data)
+    return data[pos:end]
 
 
 def u_zstr(s):
     """Unparse a zero-terminated string."""
-    if '\x00' in s:
+    if not isinstance(s, type(b'')):
+        s = s.encode('utf-8')
+    if b'\x00' in s:
         raise ValueError("string contains NUL")
-    return s + '\x00'
+    return s + b'\x00'
+
+
+def text(b):
+    """Decode a byte string as UTF-8, if it is not already a string."""
+    if isinstance(b, str):
+        return b
+    return b.decode('utf-8', 'replace')
 
 
 # Here there be dragons
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+##
+## Name:     cookiebench.py
+## Purpose:  Measure the memory used per cookie by dictionaries and records.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## This program builds a temporary Chrome cookie database with realistic
+## contents, reads its rows, and uses tracemalloc to measure the memory
+## retained by the cookies made from them, once as plain dictionaries (as
+## read_google_cookies made them before Cookie records existed) and once as
+## Cookie records.  It reports the bytes per cookie for each, and the saving
+## of the records over the dictionaries.
+##
+from __future__ import print_function
+
+import argparse, gc, os, random, shutil, sys, tempfile, tracemalloc
+
+from sqlite3 import dbapi2 as sql
+
+import cookies
+
+
+def make_store(path, count, domains, seed):
+    """Write a Chrome cookie database with count cookies spread over the
+    given number of domains to path.
+    """
+    rng = random.Random(seed)
+    hosts = list('.site%d.example.com' % i for i in range(domains))
+    names = ['_ga', '_gid', 'sid', 'session', 'prefs', 'csrf', 'lang', 'id']
+    paths = ['/', '/', '/', '/app', '/account']
+    db = sql.connect(path)
+    try:
+        db.execute('CREATE TABLE cookies (creation_utc INTEGER PRIMARY KEY, '
+                   'host_key TEXT, name TEXT, value TEXT, path TEXT, '
+                   'expires_utc INTEGER, is_secure INTEGER, '
+                   'is_httponly INTEGER)')
+        base = (cookies.gc_epoch_offset + 1500000000) * 1000000
+        db.executemany(
+            'INSERT INTO cookies VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((base + i, rng.choice(hosts), rng.choice(names), '%032x' %
+              rng.getrandbits(128), rng.choice(paths),
+              base + i + 86400 * 1000000 * rng.randint(1, 365),
+              rng.randint(0, 1), rng.randint(0, 1)) for i in range(count)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def read_rows(path):
+    """Return the fields and rows of the cookies table at path, as read by
+    GoogleCookieDB.read.
+    """
+    fk = sorted(cookies.gc_field_map)
+    db = sql.connect(path)
+    try:
+        return fk, db.execute('SELECT %s FROM cookies' %
+                              ', '.join(fk)).fetchall()
+    finally:
+        db.close()
+
+
+def measure(path, make):
+    """Return the number of bytes retained by the cookies made by make from
+    the rows of the store at path, and the number of cookies.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        fk, rows = read_rows(path)
+        cdb = list(
+            make(cookies.parse_gc_field(k, v) for k, v in zip(fk, row))
+            for row in rows)
+        del rows
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, len(cdb)
+
+
+def main(argv):
+    """Command-line entry point."""
+    ap = argparse.ArgumentParser(
+        description="Compare the memory used by cookie dicts and records.")
+    ap.add_argument('--cookies', '-n', type=int, default=20000,
+                    help="number of cookies (default %(default)s)")
+    ap.add_argument('--domains', type=int, default=500,
+                    help="number of distinct domains (default %(default)s)")
+    ap.add_argument('--seed', type=int, default=1,
+                    help="random seed (default %(default)s)")
+    opts = ap.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'Cookies')
+        make_store(path, opts.cookies, opts.domains, opts.seed)
+
+        results = []
+        for name, make in (('dict', dict), ('Cookie', cookies.Cookie)):
+            size, count = measure(path, make)
+            results.append((name, size, count))
+    finally:
+        shutil.rmtree(tmp)
+
+    for name, size, count in results:
+        print("  %-8s %10d bytes %8.1f bytes/cookie" %
+              (name, size, float(size) / count if count else 0))
+    dsize, csize = results[0][1], results[1][1]
+    if dsize > 0:
+        print("Cookie records use %.1f%% less memory than dicts." %
+              (100.0 * (dsize - csize) / dsize))
+    return 0
+
+
+if __name__ == "__main__":
+    res = main(sys.argv[1:])
+    sys.exit(res)
+
+# Here there be dragons
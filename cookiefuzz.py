@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+##
+## Name:     cookiefuzz.py
+## Purpose:  Differential testing of cookie rule matching engines.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## Faster ways of applying the rules are only safe if they reach exactly the
+## same verdicts as the plain rule-by-rule scan with match_rule.  This program
+## generates random rules in the .cookierc grammar and random cookies, runs
+## every registered engine on them, and compares each engine's kill set (which
+## cookies are removed, and by which rule) with that of the reference engine.
+## Errors count as results too: if the reference raises an exception, every
+## engine must raise the same type of exception.
+##
+## When an engine disagrees, the case is shrunk by removing cookies, rules,
+## and criteria, and by emptying values, for as long as the disagreement
+## remains.  The smallest case found is printed, and the program exits 1.
+## At the end, the throughput of each engine is reported.
+##
+## To check a new engine, add it to the engines list.
+##
+from __future__ import print_function
+
+import argparse, json, os, random, sys, tempfile, time
+from datetime import datetime, timedelta
+
+import cookies, washcookies, washpreview
+
+# Pieces from which cookies and rules are generated.  They are chosen to hit
+# the edge cases of the grammar: empty arguments, leading dots, case
+# differences, and fields that are missing from the cookie.
+fields = [
+    'Domain', 'Name', 'Path', 'Value', 'HttpOnly', 'Secure', 'Expires',
+    'Created', 'Other'
+]
+words = [
+    '', '.', 'a', 'A', 'a.com', 'A.COM', '.a.com', 'b.a.com', 'x.b.a.com',
+    'com', '.com', '_ga', '_GA', 'sid', '/', '/x'
+]
+patterns = ['', '.', '^a', 'a$', 'A', 'a|b', '^$', '[.]com', '(']
+flags = '+-!'
+epoch = datetime(1970, 1, 1)
+ops = ['=', '~', '@', '?']
+
+
+def random_cookie(rng):
+    """Return a random cookie dictionary.  Each field is present or missing at
+    random, and its key is sometimes in lower case.  The HttpOnly and Secure
+    fields are sometimes not strings, and the Expires and Created fields are
+    usually times, as in Chrome.
+    """
+    ck = {}
+    for f in fields:
+        if rng.random() < 0.2:
+            continue
+        key = f.lower() if rng.random() < 0.1 else f
+        if f in ('HttpOnly', 'Secure') and rng.random() < 0.3:
+            ck[key] = rng.choice([True, False, 0, 1])
+        elif f in ('Expires', 'Created') and rng.random() < 0.8:
+            ck[key] = epoch + timedelta(
+                seconds=rng.randrange(1 << 31),
+                microseconds=rng.choice([0, rng.randrange(10**6)]))
+        else:
+            ck[key] = rng.choice(words)
+    return ck
+
+
+def random_criterion(rng):
+    """Return the text of a random rule criterion."""
+    if rng.random() < 0.25:
+        return rng.choice(words)  # bare domain match
+    op = rng.choice(ops)
+    arg = rng.choice(patterns if op == '~' else words)
+    if op == '?':
+        arg = ''
+    if rng.random() < 0.25:
+        op = '!' + op
+    key = rng.choice(fields)
+    if rng.random() < 0.3:
+        key = key.upper()
+    return key + op + arg
+
+
+def random_rule(rng):
+    """Return the text of a random rule, as it would appear in .cookierc."""
+    n = 1 if rng.random() < 0.6 else rng.randint(2, 3)
+    sep = rng.choice(' ,|')
+    crit = list(random_criterion(rng) for _ in range(n))
+    # The separator may not appear in a criterion.
+    crit = list(c.replace(sep, '') for c in crit)
+    return rng.choice(flags) + sep + sep.join(crit)
+
+
+def parse_rules(lines):
+    """Parse rule text into lists (allow, deny, keep), as load_rules does."""
+    a, r, k = [], [], []
+    for line in lines:
+        f, rs = washcookies.parse_rule(line)
+        {'+': a, '-': r, '!': k}[f].append(rs)
+    return a, r, k
+
+
+class Engine(object):
+    """A rule matching engine under test.  prepare(cookies, allow, deny, keep)
+    converts a case into the arguments for run, which returns a kill set as
+    find_bad_cookies does.  Only the time spent in run is measured.
+    """
+
+    def __init__(self, name, prepare, run):
+        self.name = name
+        self.prepare = prepare
+        self.run = run
+        self.cookies = 0
+        self.seconds = 0.0
+
+    def __call__(self, cdb, allow, deny, keep):
+        args = self.prepare(cdb, allow, deny, keep)
+        start = time.time()
+        try:
+            return self.run(*args)
+        finally:
+            self.seconds += time.time() - start
+            self.cookies += len(cdb)
+
+
+def reference_find(cdb, allow, deny, keep):
+    """The reference engine: scan every rule in order with match_rule."""
+    match = washcookies.match_rule
+    kill = {}
+    for pos, cookie in enumerate(cdb):
+        if any(match(cookie, rule) for rule in keep):
+            continue
+        for rule in deny:
+            if match(cookie, rule):
+                kill[pos] = rule
+                break
+        else:
+            if not any(match(cookie, rule) for rule in allow):
+                kill[pos] = None
+    return kill
+
+
+def as_is(*args):
+    return args
+
+
+def with_rulesets(cdb, allow, deny, keep):
+    return (cdb, washcookies.RuleSet(allow), washcookies.RuleSet(deny),
+            washcookies.RuleSet(keep))
+
+
+def with_records(cdb, allow, deny, keep):
+    return with_rulesets(list(cookies.Cookie(c) for c in cdb), allow, deny,
+                         keep)
+
+
+def with_snapshot(cdb, allow, deny, keep):
+    """Pass the cookies through a store snapshot that is taken, saved, and
+    loaded again, as cached_snapshot does.
+    """
+    fd, path = tempfile.mkstemp(suffix='.snapshot')
+    os.close(fd)
+    try:
+        washpreview.Snapshot.read([('fuzz', lambda _: cdb)]).save(path)
+        cdb = washpreview.Snapshot.load(path).stores['fuzz']
+    finally:
+        os.unlink(path)
+    return with_rulesets(cdb, allow, deny, keep)
+
+
+engines = [
+    Engine('reference', as_is, reference_find),
+    Engine('ruleset', with_rulesets, washcookies.find_bad_cookies),
+    Engine('records', with_records, washcookies.find_bad_cookies),
+    Engine('snapshot', with_snapshot, washcookies.find_bad_cookies),
+]
+
+
+def outcome(engine, cdb, lines):
+    """Run engine on a case, returning a comparable summary of the result:
+    either ('ok', kills), where kills maps each position to the index of the
+    rejecting rule in the text (or None), or ('error', exception type name).
+    """
+    allow, deny, keep = parse_rules(lines)
+    where = {}
+    for i, line in enumerate(lines):
+        if line.startswith('-'):
+            where[id(deny[len(where)])] = i
+    try:
+        kill = engine(cdb, allow, deny, keep)
+    except Exception as e:
+        return ('error', type(e).__name__)
+    return ('ok', dict((p, None if r is None else where[id(r)])
+                       for p, r in kill.items()))
+
+
+def disagreement(cdb, lines, candidates=None):
+    """Return the first engine whose outcome differs from the reference on the
+    given case, or None if all agree.
+    """
+    want = outcome(engines[0], cdb, lines)
+    for eng in candidates or engines[1:]:
+        if outcome(eng, cdb, lines) != want:
+            return eng
+    return None
+
+
+def shrink(cdb, lines, eng):
+    """Shrink a case on which eng disagrees with the reference, returning a
+    smaller case on which it still disagrees.
+    """
+
+    def fails(c, l):
+        return disagreement(c, l, [eng]) is not None
+
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(cdb) - 1, -1, -1):
+            c = cdb[:i] + cdb[i + 1:]
+            if fails(c, lines):
+                cdb, changed = c, True
+        for i in range(len(lines) - 1, -1, -1):
+            l = lines[:i] + lines[i + 1:]
+            if fails(cdb, l):
+                lines, changed = l, True
+        for i, line in enumerate(lines):
+            sep, crit = line[1], line[2:].split(line[1])
+            for j in range(len(crit)):
+                if len(crit) == 1:
+                    break
+                l = list(lines)
+                l[i] = line[:2] + sep.join(crit[:j] + crit[j + 1:])
+                if fails(cdb, l):
+                    lines, changed = l, True
+                    break
+        for i, ck in enumerate(cdb):
+            for k in list(ck):
+                for c in ({}, {k: ''}):
+                    trial = dict(ck)
+                    trial.pop(k)
+                    trial.update(c)
+                    if trial == ck:
+                        continue
+                    cs = cdb[:i] + [trial] + cdb[i + 1:]
+                    if fails(cs, lines):
+                        cdb, ck, changed = cs, trial, True
+                        break
+    return cdb, lines
+
+
+def check_preview(rng, ncookies, nrules):
+    """Check that washpreview.affected finds every cookie whose verdict differs
+    between two random rule sets.  Returns a failing case, or None.
+    """
+    cdb = list(random_cookie(rng) for _ in range(ncookies))
+    old = list(random_rule(rng) for _ in range(nrules))
+    new = list(r for r in old if rng.random() < 0.7)
+    new += list(random_rule(rng) for _ in range(rng.randint(0, 2)))
+    ors = tuple(washcookies.RuleSet(rs) for rs in parse_rules(old))
+    nrs = tuple(washcookies.RuleSet(rs) for rs in parse_rules(new))
+    snap = washpreview.Snapshot({'fuzz': list(cookies.Cookie(c) for c in cdb)})
+    try:
+        was = washcookies.find_bad_cookies(cdb, *ors)
+        now = washcookies.find_bad_cookies(cdb, *nrs)
+        changed = list(r for _, _, r in washpreview.diff_rules(ors, nrs))
+        found = set(p for _, p in washpreview.affected(snap, changed))
+    except Exception:
+        return None  # errors are checked by the engines
+    flips = set(p for p in range(len(cdb)) if (p in was) != (p in now))
+    if flips - found:
+        return cdb, old, new
+    return None
+
+
+def main(argv):
+    """Command-line entry point."""
+    ap = argparse.ArgumentParser(
+        description="Compare rule matching engines on random cases.")
+    ap.add_argument('--seed', type=int, default=None,
+                    help="random seed (default: chosen at random)")
+    ap.add_argument('--iterations', '-n', type=int, default=2000,
+                    help="number of cases (default %(default)s)")
+    ap.add_argument('--cookies', type=int, default=20,
+                    help="cookies per case (default %(default)s)")
+    ap.add_argument('--rules', type=int, default=8,
+                    help="rules per case (default %(default)s)")
+    opts = ap.parse_args(argv)
+
+    seed = opts.seed
+    if seed is None:
+        seed = random.randrange(1 << 30)
+    rng = random.Random(seed)
+    print("Seed %d" % seed, file=sys.stderr)
+
+    for it in range(opts.iterations):
+        cdb = list(random_cookie(rng) for _ in range(opts.cookies))
+        lines = list(random_rule(rng) for _ in range(opts.rules))
+        eng = disagreement(cdb, lines)
+        if eng is not None:
+            cdb, lines = shrink(cdb, lines, eng)
+            print("Engine %r disagrees with the reference (case %d):" %
+                  (eng.name, it),
+                  file=sys.stderr)
+            for line in lines:
+                print("  rule   %s" % line, file=sys.stderr)
+            for ck in cdb:
+                print("  cookie %s" %
+                      json.dumps(ck, sort_keys=True, default=str),
+                      file=sys.stderr)
+            print("  want   %r" % (outcome(engines[0], cdb, lines), ),
+                  file=sys.stderr)
+            print("  got    %r" % (outcome(eng, cdb, lines), ),
+                  file=sys.stderr)
+            return 1
+
+        bad = check_preview(rng, opts.cookies, opts.rules)
+        if bad is not None:
+            cdb, old, new = bad
+            print("Preview missed a verdict change (case %d):" % it,
+                  file=sys.stderr)
+            print("  old %r\n  new %r" % (old, new), file=sys.stderr)
+            for ck in cdb:
+                print("  cookie %s" %
+                      json.dumps(ck, sort_keys=True, default=str),
+                      file=sys.stderr)
+            return 1
+
+    print("%d cases, all engines agree." % opts.iterations, file=sys.stderr)
+    for eng in engines:
+        rate = eng.cookies / eng.seconds if eng.seconds else 0
+        print("  %-12s %10.0f cookies/sec" % (eng.name, rate), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    res = main(sys.argv[1:])
+    sys.exit(res)
+
+__all__ = (
+    "Engine",
+    "engines",
+    "main",
+)
+
+# Here there be dragons
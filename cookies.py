@@ -17,6 +17,16 @@ try:
 except ImportError as e:
     NSHTTPCookieStorage = None
 
+try:
+    intern
+except NameError:
+    from sys import intern
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
 
 def get_user_home(user=None):
     """Find the specified user's home directory, or use the owner of
@@ -28,6 +38,117 @@ def get_user_home(user=None):
         return pwd.getpwnam(user).pw_dir
 
 
+## Cookie records
+
+
+class Cookie(object):
+    """A single cookie.  A Cookie behaves like a dictionary mapping field names
+    to values, but the common fields are stored in slots rather than a
+    per-cookie dictionary, and the Domain, Name, and Path strings are
+    interned, since they are typically shared by many cookies.  Fields that
+    have not been set are absent, as for a dictionary.  Other fields are stored
+    in an auxiliary dictionary that is only allocated if needed.
+    """
+    __slots__ = ('Created', 'Domain', 'Expires', 'Name', 'Path', 'Secure',
+                 'HttpOnly', 'Value', 'creation_utc', 'extra')
+
+    # The names of the fields stored in slots.
+    fields = __slots__[:-1]
+
+    slot_names = frozenset(fields)
+
+    # Map from lower-case field names to slot names.
+    slot_map = dict((f.lower(), f) for f in fields)
+
+    def __init__(self, data=(), **kw):
+        # Set the fields directly from data, which may be a mapping or a
+        # sequence of pairs, rather than building a dictionary first.
+        self.extra = None
+        if hasattr(data, 'items'):
+            data = data.items()
+        for k, v in data:
+            self[k] = v
+        for k, v in kw.items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        if key in self.slot_names:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.slot_names:
+            if key in ('Domain', 'Name', 'Path') and isinstance(value, str):
+                value = intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'Cookie(%r)' % self.as_dict()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(k for k, v in self.items())
+
+    def items(self):
+        out = []
+        for f in self.fields:
+            try:
+                out.append((f, getattr(self, f)))
+            except AttributeError:
+                pass
+        if self.extra:
+            out.extend(self.extra.items())
+        return out
+
+    def lookup(self, key):
+        """Look up the field named by key (a lower-case string), ignoring
+        case.  Returns a tuple (exists, value), where value is '' if the
+        cookie has no such field.
+        """
+        f = self.slot_map.get(key)
+        if f is not None:
+            try:
+                return True, getattr(self, f)
+            except AttributeError:
+                pass
+        if self.extra:
+            for k, v in self.extra.items():
+                if key == k.lower():
+                    return True, v
+        return False, ''
+
+    def as_dict(self):
+        """Return the fields of the cookie as a new dictionary."""
+        return dict(self.items())
+
+
 ## New style Apple binarycookies file
 
 # This offset corresponds to 2001-01-01 00:00:00 +0000 in Unix time.
@@ -49,7 +170,7 @@ def get_apple_bincookie_path(user=None):
 
 def read_binary_cookies(path):
     """Read a cookie list from an Apple binarycookies file.  Returns a list of
-    dictionaries.
+    Cookie records.
     """
     if NSHTTPCookieStorage is None:
         raise NotImplementedError(
@@ -61,7 +182,7 @@ def read_binary_cookies(path):
         props = raw_cookie.properties()
         created = float(props['Created']) + osx_epoch_offset
         expires = float(props['Expires'].timeIntervalSince1970())
-        cookies.append({
+        cookies.append(Cookie({
             'raw': raw_cookie,
             'Created': datetime.fromtimestamp(created),
             'Domain': unicode(props['Domain']),
@@ -70,7 +191,7 @@ def read_binary_cookies(path):
             'Path': unicode(props['Path']),
             'Secure': bool(raw_cookie.isSecure()),
             'Value': unicode(props['Value']),
-        })
+        }))
     return cookies
 
 
@@ -106,9 +227,14 @@ def get_apple_cookie_path(user=None):
 
 def read_apple_cookies(path):
     """Read a cookie list from an Apple style plist file.  Returns a
-    list of dictionaries.
+    list of Cookie records.
     """
-    return plistlib.readPlist(path)
+    if hasattr(plistlib, 'load'):
+        with open(path, 'rb') as fp:
+            data = plistlib.load(fp)
+    else:
+        data = plistlib.readPlist(path)
+    return list(Cookie(d) for d in data)
 
 
 def write_apple_cookies(cookies, path):
@@ -116,9 +242,14 @@ def write_apple_cookies(cookies, path):
     """
     d = os.path.split(path)[0]
 
+    data = list(dict(c.items()) for c in cookies)
     fd, name = tempfile.mkstemp(dir=d, text=True)
-    with os.fdopen(fd, 'wt') as ofp:
-        plistlib.writePlist(cookies, ofp)
+    if hasattr(plistlib, 'dump'):
+        with os.fdopen(fd, 'wb') as ofp:
+            plistlib.dump(data, ofp)
+    else:
+        with os.fdopen(fd, 'wt') as ofp:
+            plistlib.writePlist(data, ofp)
 
     try:
         os.rename(name, path)
@@ -200,22 +331,215 @@ def unparse_utc(dt, epoch):
     return tsec
 
 
-def read_google_cookies(path):
-    """Read a cookie list from a Google Chrome SQLite cookie file
-    located at path.  Returns a list of dictionaries.
+class GoogleCookieDB(object):
+    """A connection to a Google Chrome SQLite cookie file located at path,
+    shared by the read, delete, and compaction steps for that file.
+
+    Chrome may hold the database open while we work on it, so every step
+    waits up to timeout seconds for a lock (the SQLite busy timeout), and if
+    the database is still busy, retries up to retries more times, sleeping
+    backoff seconds before the first retry and doubling after each.  The
+    total time spent waiting for locks is accumulated in lock_wait.
+
+    If snapshot is true, reads are served from an in-memory copy of the
+    database taken with the SQLite backup API, so that the file is only locked
+    for as long as the copy takes.
+
+    If readonly is true, the database is opened read-only and treated as
+    immutable, as for a copy that nothing else is using.  This requires
+    Python 3.
     """
-    db = sql.connect(path)
-    try:
-        cur = db.cursor()
+
+    def __init__(self, path, timeout=5.0, retries=3, backoff=0.1,
+                 snapshot=False, readonly=False):
+        if not os.path.isfile(path):
+            raise IOError("no such file: %r" % path)
+        self.path = path
+        self.retries = retries
+        self.backoff = backoff
+        self.snapshot = snapshot
+        self.lock_wait = 0.0
+        if readonly:
+            uri = 'file:%s?mode=ro&immutable=1' % quote(os.path.abspath(path))
+            self.db = sql.connect(uri, timeout=timeout, isolation_level=None,
+                                  uri=True)
+        else:
+            self.db = sql.connect(path, timeout=timeout, isolation_level=None)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def locked(self, fn):
+        """Call fn(), retrying with backoff while the database is locked.
+        Returns the value of fn().  The time spent sleeping between attempts
+        is counted as lock wait.
+        """
+        delay = self.backoff
+        for i in range(self.retries + 1):
+            try:
+                return fn()
+            except sql.OperationalError as e:
+                msg = str(e)
+                if ('locked' not in msg and 'busy' not in msg) or \
+                   i == self.retries:
+                    raise
+                time.sleep(delay)
+                self.lock_wait += delay
+                delay *= 2
+
+    def wait_for(self, stmt):
+        """Execute a statement that may block waiting for a lock, counting the
+        time it takes as lock wait whether or not it succeeds.
+        """
+        start = time.time()
+        try:
+            return self.db.execute(stmt).fetchall()
+        finally:
+            self.lock_wait += time.time() - start
+
+    def transaction(self, mode, fn):
+        """Call fn(db) inside a single transaction begun with "BEGIN mode".
+
+        The lock is acquired before fn is called, and only the statements that
+        acquire locks are counted as lock wait: BEGIN IMMEDIATE takes a write
+        lock itself, while a deferred transaction takes its read lock with
+        the first read.  COMMIT may also wait for readers to finish.
+
+        If any step fails, including COMMIT, the transaction is rolled back,
+        so that a retry begins afresh.
+        """
+
+        def run():
+            self.wait_for('BEGIN ' + mode)
+            try:
+                if mode == 'DEFERRED':
+                    self.wait_for('SELECT count(*) FROM sqlite_master')
+                res = fn(self.db)
+                self.wait_for('COMMIT')
+            except:
+                # A failed COMMIT usually leaves the transaction open, but
+                # some errors end it; in_transaction is new in Python 3.2.
+                if getattr(self.db, 'in_transaction', True):
+                    self.db.execute('ROLLBACK')
+                raise
+            return res
+
+        return self.locked(run)
+
+    def read(self):
+        """Read the cookie list.  Returns a list of Cookie records."""
         fk = sorted(gc_field_map)
         q = 'SELECT %s FROM cookies' % ', '.join(fk)
-        out = []
-        for row in cur.execute(q):
-            out.append(dict(parse_gc_field(k, v) for k, v in zip(fk, row)))
 
-        return out
-    finally:
-        db.close()
+        def fetch(db):
+            return db.execute(q).fetchall()
+
+        if self.snapshot and hasattr(self.db, 'backup'):
+            # Copy the database inside a read transaction, so that the lock is
+            # taken (and its wait counted) before the copy begins.
+            mem = sql.connect(':memory:', isolation_level=None)
+            try:
+                self.transaction('DEFERRED', lambda db: db.backup(mem))
+                rows = fetch(mem)
+            finally:
+                mem.close()
+        else:
+            rows = self.transaction('DEFERRED', fetch)
+
+        return list(
+            Cookie(parse_gc_field(k, v) for k, v in zip(fk, row))
+            for row in rows)
+
+    def read_batch(self, after=None, limit=1000):
+        """Read up to limit cookies whose creation_utc is greater than after,
+        or from the beginning if after is None, in increasing order of
+        creation_utc.  Each batch is read in its own short transaction; to
+        read the next batch, pass the creation_utc of the last cookie returned.
+        Returns a list of Cookie records, which is empty when no cookies
+        remain.
+        """
+        fk = sorted(gc_field_map)
+        q = 'SELECT %s FROM cookies WHERE creation_utc > ? ' \
+            'ORDER BY creation_utc LIMIT ?' % ', '.join(fk)
+        lo = -1 if after is None else after
+
+        def fetch(db):
+            return db.execute(q, (lo, limit)).fetchall()
+
+        rows = self.transaction('DEFERRED', fetch)
+        return list(
+            Cookie(parse_gc_field(k, v) for k, v in zip(fk, row))
+            for row in rows)
+
+    def delete(self, cookies):
+        """Delete the specified cookies in a single write transaction."""
+        if not cookies:
+            return
+
+        # The created_utc field is a primary key for the cookies table, so
+        # we only need its value in order to identify a row.
+        keys = list((cookie['creation_utc'], ) for cookie in cookies)
+        self.transaction(
+            'IMMEDIATE', lambda db: db.executemany(
+                'DELETE FROM cookies WHERE creation_utc = ?', keys))
+
+    def compact(self, threshold=0.25):
+        """Reclaim free pages and refresh query planner statistics.
+
+        The database is only vacuumed if the fraction of its pages that are
+        on the free list is at least threshold.  If the database uses
+        incremental auto-vacuum, an incremental vacuum is run instead of a
+        full VACUUM.  Statistics are only refreshed after a vacuum.  Returns a
+        tuple (reclaimed, elapsed) giving the number of bytes by which the
+        database shrank and the time spent in seconds, or None if the
+        database was not vacuumed.
+
+        The size is measured in pages rather than by the size of the file,
+        since in WAL mode a vacuum is written to the log, and the file only
+        shrinks when the log is checkpointed.  A checkpoint is attempted
+        afterward, so that the log does not keep the space.
+        """
+        start = time.time()
+
+        def run():
+            db = self.db
+            pages = db.execute('PRAGMA page_count').fetchone()[0]
+            free = db.execute('PRAGMA freelist_count').fetchone()[0]
+            if not pages or float(free) / pages < threshold:
+                return None
+
+            mode = db.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode == 2:  # incremental
+                db.execute('PRAGMA incremental_vacuum').fetchall()
+            else:
+                db.execute('VACUUM')
+            after = db.execute('PRAGMA page_count').fetchone()[0]
+            size = db.execute('PRAGMA page_size').fetchone()[0]
+            db.execute('ANALYZE')
+            if db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            return max(0, pages - after) * size
+
+        saved = self.locked(run)
+        if saved is None:
+            return None
+        return saved, time.time() - start
+
+
+def read_google_cookies(path):
+    """Read a cookie list from a Google Chrome SQLite cookie file
+    located at path.  Returns a list of Cookie records.
+    """
+    with GoogleCookieDB(path) as db:
+        return db.read()
 
 
 def delete_google_cookies(cookies, path):
@@ -224,18 +548,17 @@ def delete_google_cookies(cookies, path):
     """
     if not cookies:
         return
+    with GoogleCookieDB(path) as db:
+        db.delete(cookies)
 
-    # The created_utc field is a primary key for the cookies table, so
-    # we only need its value in order to identify a row.
-    db = sql.connect(path)
-    try:
-        cur = db.cursor()
-        for cookie in cookies:
-            cur.execute('DELETE FROM cookies WHERE creation_utc = ?',
-                        (cookie['creation_utc'], ))
-        db.commit()
-    finally:
-        db.close()
+
+def compact_google_cookies(path, threshold=0.25):
+    """Reclaim free pages in a Google Chrome SQLite cookie file located at
+    path, if there are enough of them to be worth it.  See
+    GoogleCookieDB.compact.
+    """
+    with GoogleCookieDB(path) as db:
+        return db.compact(threshold)
 
 
 # Here there be dragons
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+##
+## Name:     cookiescan.py
+## Purpose:  Check collected cookie stores against washcookies rules.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## This program applies a set of washcookies rules to cookie stores that have
+## been copied off the machines that made them, on any system.  It takes files,
+## directories (searched recursively), or glob patterns, and recognizes each
+## store by its content rather than its name:
+##
+##   Apple binarycookies -- begins with "cook"
+##   Chrome SQLite       -- begins with "SQLite format 3"
+##   Apple plist         -- binary ("bplist") or XML property list
+##
+## All the formats are parsed in Python, without the ObjectiveC bridge, and no
+## store is modified.  Files are scanned by a pool of worker processes, and one
+## JSON record per file is written to the output as soon as the file is done.
+## Each record reports the number of cookies, the cookies the rules would
+## remove (grouped by domain and rule), and the time taken.  A file in one of
+## these formats that does not hold cookies (an SQLite database without a
+## cookies table, or a property list that is not a list of dictionaries) is
+## reported as skipped rather than as an error.  A summary of the whole scan
+## is printed to stderr at the end.
+##
+from __future__ import print_function
+
+import argparse, glob, json, multiprocessing, os, plistlib, sys, time
+
+import cookies, washcookies
+
+try:
+    import bincookies
+except ImportError:
+    sys.path.append(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'binary'))
+    try:
+        import bincookies
+    except ImportError:
+        bincookies = None
+
+# Leading bytes identifying each supported format.
+sqlite_magic = b'SQLite format 3\x00'
+bplist_magic = b'bplist'
+xml_magics = (b'<?xml', b'<!DOCTYPE plist', b'<plist')
+
+
+def sniff(path):
+    """Return the format of the cookie store at path, one of "binary",
+    "sqlite", or "plist", or None if it is not recognized.
+    """
+    with open(path, 'rb') as fp:
+        head = fp.read(512)
+    if bincookies is not None and head.startswith(bincookies.FILE_MAGIC):
+        return 'binary'
+    if head.startswith(sqlite_magic):
+        return 'sqlite'
+    if head.startswith(bplist_magic):
+        return 'plist'
+    body = head.lstrip()
+    if body.startswith(xml_magics) and b'plist' in head:
+        return 'plist'
+    return None
+
+
+class NotCookies(Exception):
+    """Raised by a reader for a file that is in a cookie store format but does
+    not hold cookies.
+    """
+
+
+def read_binary(path):
+    with open(path, 'rb') as fp:
+        return bincookies.parse_cookies(fp.read())
+
+
+def read_sqlite(path):
+    with cookies.GoogleCookieDB(path, readonly=True) as db:
+        if not db.db.execute("SELECT 1 FROM sqlite_master "
+                             "WHERE type = 'table' AND name = 'cookies'"
+                             ).fetchall():
+            raise NotCookies("no cookies table")
+        return db.read()
+
+
+def read_plist(path):
+    with open(path, 'rb') as fp:
+        if hasattr(plistlib, 'load'):
+            data = plistlib.load(fp)
+        else:
+            data = plistlib.readPlist(fp)
+    if not isinstance(data, list) or \
+       not all(isinstance(d, dict) for d in data):
+        raise NotCookies("not a list of dictionaries")
+    return list(cookies.Cookie(d) for d in data)
+
+
+readers = {
+    'binary': read_binary,
+    'sqlite': read_sqlite,
+    'plist': read_plist,
+}
+
+
+def find_files(args):
+    """Generate the paths of the files named by args, which may be files,
+    directories (searched recursively), or glob patterns.  Each file is only
+    generated once.
+    """
+    seen = set()
+    for path in walk_args(args):
+        key = os.path.realpath(path)
+        if key not in seen:
+            seen.add(key)
+            yield path
+
+
+def walk_args(args):
+    for arg in args:
+        if os.path.isdir(arg):
+            for root, dirs, files in os.walk(arg):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        elif os.path.exists(arg):
+            yield arg
+        else:
+            for path in sorted(glob.glob(arg)):
+                if os.path.isdir(path):
+                    for sub in walk_args([path]):
+                        yield sub
+                else:
+                    yield path
+
+
+# The rules used by scan_file, set in each worker by init_worker.
+rules = None
+
+
+def init_worker(cpath):
+    global rules
+    rules = washcookies.read_rules(cpath)
+
+
+def scan_file(path):
+    """Check the cookie store at path against the rules.  Returns a dictionary
+    describing the result, or None if path is not a recognized store.  If the
+    store holds no cookies, the result has a "skipped" field giving the reason.
+    """
+    start = time.time()
+    out = {'path': path}
+    try:
+        fmt = sniff(path)
+        if fmt is None:
+            return None
+        out['format'] = fmt
+        out['bytes'] = os.path.getsize(path)
+        cdb = readers[fmt](path)
+        icky = washcookies.find_bad_cookies(cdb, *rules)
+    except NotCookies as e:
+        out['skipped'] = str(e)
+        out['seconds'] = time.time() - start
+        return out
+    except Exception as e:
+        out['error'] = '%s: %s' % (type(e).__name__, e)
+        out['seconds'] = time.time() - start
+        return out
+
+    out['cookies'] = len(cdb)
+    out['removed'] = len(icky)
+    out['groups'] = list({
+        'domain': domain,
+        'rule': washcookies.rule_text(reason) if reason else '',
+        'count': count,
+        'samples': samples,
+    } for domain, reason, count, samples in washcookies.group_changes(
+        cdb, icky))
+    elapsed = time.time() - start
+    out['seconds'] = elapsed
+    if elapsed > 0:
+        out['bytes_per_sec'] = out['bytes'] / elapsed
+        out['cookies_per_sec'] = len(cdb) / elapsed
+    return out
+
+
+def scan(paths, cpath, ofp, workers=None):
+    """Scan the given files with a pool of workers, writing one JSON record
+    per recognized store to ofp.  Returns a dictionary of totals.
+    """
+    totals = {
+        'files': 0,
+        'skipped': 0,
+        'errors': 0,
+        'cookies': 0,
+        'removed': 0,
+        'bytes': 0,
+    }
+    start = time.time()
+    pool = multiprocessing.Pool(workers, init_worker, (cpath, ))
+    try:
+        for res in pool.imap_unordered(scan_file, paths, chunksize=8):
+            if res is None:
+                continue
+            ofp.write(json.dumps(res, default=str) + '\n')
+            ofp.flush()
+            if 'skipped' in res:
+                totals['skipped'] += 1
+                continue
+            totals['files'] += 1
+            if 'error' in res:
+                totals['errors'] += 1
+            else:
+                totals['cookies'] += res['cookies']
+                totals['removed'] += res['removed']
+                totals['bytes'] += res['bytes']
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    totals['seconds'] = time.time() - start
+    return totals
+
+
+def main(argv):
+    """Command-line entry point."""
+    ap = argparse.ArgumentParser(
+        description="Check collected cookie stores against washcookies rules.")
+    ap.add_argument('paths', nargs='+', metavar='path',
+                    help="a file, directory, or glob pattern to scan")
+    ap.add_argument('--rules', default=washcookies.rules_path(),
+                    help="rules file (default %(default)s)")
+    ap.add_argument('--output', '-o', default='-',
+                    help="result file, or - for stdout (default %(default)s)")
+    ap.add_argument('--workers', '-j', type=int, default=None,
+                    help="number of worker processes (default: one per CPU)")
+    opts = ap.parse_args(argv)
+
+    # Check the rules here, so that a bad rules file is reported once, before
+    # any work is done, rather than by every worker.
+    try:
+        washcookies.read_rules(opts.rules)
+    except (IOError, OSError, ValueError) as e:
+        print("Unable to read rules from '%s': %s" % (opts.rules, e),
+              file=sys.stderr)
+        return 2
+
+    if opts.output == '-':
+        ofp = sys.stdout
+    else:
+        ofp = open(opts.output, 'wt')
+    try:
+        totals = scan(find_files(opts.paths), opts.rules, ofp, opts.workers)
+    finally:
+        if ofp is not sys.stdout:
+            ofp.close()
+
+    sec = totals['seconds']
+    print("Scanned %d store%s (%d error%s, %d skipped) in %.2f sec: "
+          "%d cookies, %d removed, %.1f MB/sec" %
+          (totals['files'], "s" if totals['files'] != 1 else "",
+           totals['errors'], "s" if totals['errors'] != 1 else "",
+           totals['skipped'], sec,
+           totals['cookies'], totals['removed'],
+           totals['bytes'] / sec / 1e6 if sec > 0 else 0),
+          file=sys.stderr)
+    return 1 if totals['errors'] else 0
+
+
+if __name__ == "__main__":
+    res = main(sys.argv[1:])
+    sys.exit(res)
+
+__all__ = (
+    "sniff",
+    "scan_file",
+    "scan",
+    "main",
+)
+
+# Here there be dragons
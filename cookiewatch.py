@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+##
+## Name:     cookiewatch.py
+## Purpose:  Wash web cookies continuously as the cookie stores change.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## This program runs the washcookies rules as a long-lived process.  It keeps
+## the rules loaded, and watches the ".cookierc" file and the cookie stores for
+## changes, using inotify on Linux and polling elsewhere.  A burst of changes
+## is collected into a single wash once the stores have been quiet for a short
+## while.  Only cookies that have not already been washed are checked; if the
+## rules change, they are reloaded and all the cookies are checked again.
+##
+## Sending the process SIGUSR1 prints its counters to stderr.  The environment
+## variables of washcookies.py (WC_DRY_RUN, WC_EXPLAIN, ...) apply here too.
+##
+from __future__ import print_function
+
+import argparse, ctypes, ctypes.util, errno, os, re, select, signal, struct
+import sys, time
+from sqlite3 import dbapi2 as sql
+
+import cookies, washcookies
+
+# Event masks from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# The header of an inotify event: wd, mask, cookie, len.
+event_header = struct.Struct('iIII')
+
+
+def companions(path):
+    """Return the files whose changes count as changes to path.  SQLite keeps
+    uncommitted changes in a journal or write-ahead log beside the database.
+    """
+    return [path, path + '-journal', path + '-wal']
+
+
+class InotifyWatcher(object):
+    """Watch a set of files for changes using Linux inotify.  The directories
+    containing the files are watched, so that files replaced by renaming are
+    still seen.  Raises OSError if inotify is not available.
+    """
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs = {}  # wd -> directory
+        self.names = {}  # (directory, file name) -> watched path
+        for path in paths:
+            d = os.path.dirname(path)
+            for p in companions(path):
+                self.names[d, os.path.basename(p)] = path
+            if d in self.dirs.values() or not os.path.isdir(d):
+                continue
+
+            bd = d
+            if not isinstance(bd, type(b'')):
+                bd = bd.encode(sys.getfilesystemencoding())
+            wd = libc.inotify_add_watch(self.fd, bd, watch_mask)
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds (or indefinitely if None) for changes.
+        Returns the set of watched paths that changed.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed = set()
+        pos = 0
+        while pos + event_header.size <= len(data):
+            wd, mask, _, n = event_header.unpack_from(data, pos)
+            pos += event_header.size
+            name = data[pos:pos + n].rstrip(b'\x00')
+            pos += n
+            d = self.dirs.get(wd)
+            if d is None:
+                continue
+            if not isinstance(d, type(b'')):
+                name = name.decode(sys.getfilesystemencoding())
+            path = self.names.get((d, name))
+            if path is not None:
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher(object):
+    """Watch a set of files for changes by checking their modification times
+    and sizes every interval seconds.
+    """
+
+    def __init__(self, paths, interval=2.0):
+        self.paths = list(paths)
+        self.interval = interval
+        self.state = dict((p, self.stat(p)) for p in self.paths)
+
+    @staticmethod
+    def stat(path):
+        out = []
+        for p in companions(path):
+            try:
+                st = os.stat(p)
+                out.append((st.st_mtime, st.st_size))
+            except OSError:
+                out.append(None)
+        return out
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds (or indefinitely if None) for changes.
+        Returns the set of watched paths that changed.
+        """
+        start = time.time()
+        while True:
+            changed = set()
+            for p in self.paths:
+                st = self.stat(p)
+                if st != self.state[p]:
+                    self.state[p] = st
+                    changed.add(p)
+            if changed:
+                return changed
+
+            left = self.interval
+            if timeout is not None:
+                left = min(left, start + timeout - time.time())
+                if left <= 0:
+                    return changed
+            time.sleep(left)
+
+    def close(self):
+        pass
+
+
+def make_watcher(paths, poll=False, interval=2.0):
+    """Return an inotify watcher for paths if possible, unless poll is true;
+    otherwise return a polling watcher.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollWatcher(paths, interval)
+
+
+def collect(watcher, debounce=1.0, max_delay=10.0, timeout=None):
+    """Wait for changes, then keep collecting changes until none have arrived
+    for debounce seconds, or max_delay seconds have passed since the first.
+    Returns the set of paths that changed, which is empty if there were no
+    changes within timeout seconds.
+    """
+    changed = watcher.wait(timeout)
+    if not changed:
+        return changed
+
+    first = time.time()
+    while time.time() - first < max_delay:
+        more = watcher.wait(min(debounce, first + max_delay - time.time()))
+        if not more:
+            break
+        changed |= more
+    return changed
+
+
+def last_change(path):
+    """Return the latest modification time of path or its companions, or None
+    if none of them exists.
+    """
+    ts = []
+    for p in companions(path):
+        try:
+            ts.append(os.stat(p).st_mtime)
+        except OSError:
+            pass
+    return max(ts) if ts else None
+
+
+def check_patterns(rules):
+    """Compile the patterns of the "~" criteria in rules, a tuple of RuleSets
+    as returned by read_rules, so that a bad pattern is found when the rules
+    are loaded rather than when a cookie is first checked.  Raises re.error
+    if a pattern is malformed.
+    """
+    for rs in rules:
+        for rule in rs:
+            for op, key, arg in rule:
+                if op.lstrip('!') == '~':
+                    re.compile(arg)
+
+
+def cookie_key(cookie):
+    """Return a key identifying the content of a cookie that rules may test,
+    which is every field but the raw Foundation cookie object.
+    """
+    return tuple(sorted((k, v) for k, v in cookie.items() if k != 'raw'))
+
+
+class Stats(object):
+    """Counters describing the work done by a Washer."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = 0  # changed paths reported by the watcher
+        self.washes = 0  # stores washed
+        self.reloads = 0  # times the rules were reloaded
+        self.checked = 0  # cookies checked against the rules
+        self.killed = 0  # cookies removed
+        self.errors = 0  # washes that failed
+        self.latency_last = 0.0  # seconds from write to wash, last wash
+        self.latency_max = 0.0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def record_latency(self, sec):
+        self.latency_last = sec
+        self.latency_max = max(self.latency_max, sec)
+        self.latency_sum += sec
+        self.latency_count += 1
+
+    def report(self, ofp=sys.stderr):
+        mean = 0
+        if self.latency_count:
+            mean = self.latency_sum / self.latency_count
+        print("Up %.0f sec: %d events, %d washes (%d failed), %d reloads, "
+              "%d cookies checked, %d removed" %
+              (time.time() - self.started, self.events, self.washes,
+               self.errors, self.reloads, self.checked, self.killed),
+              file=ofp)
+        print("Write-to-wash latency: last %.3f, mean %.3f, max %.3f sec" %
+              (self.latency_last, mean, self.latency_max),
+              file=ofp)
+
+
+class Washer(object):
+    """Wash the cookie stores of the current user incrementally, remembering
+    which cookies have already been checked against the rules in cpath.
+    """
+
+    def __init__(self, cpath=None, dry_run=False):
+        self.cpath = cpath or washcookies.rules_path()
+        self.dry_run = dry_run
+        self.stats = Stats()
+        self.stores = {
+            cookies.get_apple_cookie_path():
+            (self.wash_file, cookies.read_apple_cookies,
+             cookies.write_apple_cookies),
+            cookies.get_apple_bincookie_path():
+            (self.wash_file, cookies.read_binary_cookies,
+             cookies.write_binary_cookies),
+            cookies.get_google_cookie_path(): (self.wash_google, ),
+        }
+        self.rules = washcookies.load_rules(cpath=self.cpath)
+        check_patterns(self.rules)
+        self.reset()
+
+    def reset(self):
+        """Forget which cookies have been checked."""
+        self.seen = {}  # store path -> set of cookie keys already checked
+        self.last = None  # largest Chrome creation_utc already checked
+
+    def load(self):
+        """Reload the rules, and forget which cookies have been checked.  If
+        the rules cannot be read, the error is reported and the previous rules
+        are kept.  Returns True if the rules were reloaded.
+        """
+        try:
+            rules = washcookies.read_rules(self.cpath)
+            check_patterns(rules)
+        except (IOError, OSError, ValueError, re.error) as e:
+            print("Unable to reload rules, keeping the old ones: %s" % e,
+                  file=sys.stderr)
+            return False
+        self.rules = rules
+        washcookies.rule_text_cache.clear()
+        self.reset()
+        return True
+
+    def paths(self):
+        """Return the paths of the rules file and the cookie stores."""
+        return [self.cpath] + sorted(self.stores)
+
+    def wash(self, path):
+        """Wash the new cookies in the store at path, and record the latency
+        from the last write of the store.  If the store cannot be washed (for
+        example, if it stays locked), the error is reported, and the store is
+        washed again when it next changes.
+        """
+        changed_at = last_change(path)
+        fn = self.stores[path]
+        self.stats.washes += 1
+        try:
+            fn[0](path, *fn[1:])
+        except (sql.Error, IOError, OSError) as e:
+            print("Unable to wash '%s': %s" % (path, e), file=sys.stderr)
+            self.stats.errors += 1
+            return
+        if changed_at is not None:
+            self.stats.record_latency(max(0.0, time.time() - changed_at))
+
+    def wash_all(self):
+        for path in sorted(self.stores):
+            self.wash(path)
+
+    def handle(self, changed):
+        """Handle a set of changed paths from a watcher."""
+        self.stats.events += len(changed)
+        if self.cpath in changed:
+            print("Reloading rules from '%s'" % self.cpath, file=sys.stderr)
+            if self.load():
+                self.stats.reloads += 1
+                self.wash_all()
+                return
+
+        for path in sorted(changed):
+            if path in self.stores:
+                self.wash(path)
+
+    def wash_file(self, path, read, write):
+        """Wash a store that is read and written as a whole file."""
+        try:
+            cdb = read(path)
+        except (IOError, NotImplementedError):
+            return  # No cookies found, skip the rest.
+
+        seen = self.seen.get(path, ())
+        fresh = list(c for c in cdb if cookie_key(c) not in seen)
+        self.stats.checked += len(fresh)
+        icky = washcookies.find_bad_cookies(fresh, *self.rules)
+        kept = cdb
+        if icky:
+            washcookies.summarize_changes(fresh, icky, path)
+            self.stats.killed += len(icky)
+            kills = set(id(fresh[p]) for p in icky)
+            if self.dry_run:
+                print("(skipping write)", file=sys.stderr)
+            else:
+                kept = list(c for c in cdb if id(c) not in kills)
+                write(kept, path)
+
+        # Only the survivors count as seen, so that a removed cookie is
+        # removed again if it comes back.
+        self.seen[path] = set(cookie_key(c) for c in kept)
+
+    def wash_google(self, path):
+        """Wash the cookies added to a Chrome store since the last wash."""
+        try:
+            store = washcookies.open_google_cookies(path)
+        except IOError:
+            return  # No cookies found, skip the rest.
+
+        with store:
+            fresh, icky = [], {}
+            while True:
+                batch = store.read_batch(self.last)
+                if not batch:
+                    break
+                bad = washcookies.find_bad_cookies(batch, *self.rules)
+                for pos, reason in bad.items():
+                    icky[pos + len(fresh)] = reason
+                fresh.extend(batch)
+                if bad and not self.dry_run:
+                    store.delete(list(batch[p] for p in sorted(bad)))
+                # Move past the batch only once it is done, so that if the
+                # delete fails, the batch is checked again next time.
+                self.last = batch[-1]['creation_utc']
+
+        self.stats.checked += len(fresh)
+        if icky:
+            washcookies.summarize_changes(fresh, icky, path)
+            self.stats.killed += len(icky)
+            if self.dry_run:
+                print("(skipping write)", file=sys.stderr)
+
+
+def main(argv):
+    """Command-line entry point."""
+    ap = argparse.ArgumentParser(
+        description="Wash web cookies whenever the cookie stores change.")
+    ap.add_argument('--poll', action='store_true',
+                    help="poll for changes instead of using inotify")
+    ap.add_argument('--interval', type=float, default=2.0,
+                    help="seconds between polls (default %(default)s)")
+    ap.add_argument('--debounce', type=float, default=1.0,
+                    help="seconds of quiet before washing "
+                    "(default %(default)s)")
+    ap.add_argument('--max-delay', type=float, default=10.0,
+                    help="longest delay before washing a burst of changes "
+                    "(default %(default)s)")
+    opts = ap.parse_args(argv)
+
+    washer = Washer(dry_run=bool(os.getenv('WC_DRY_RUN')))
+    watcher = make_watcher(washer.paths(), opts.poll, opts.interval)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda *_: washer.stats.report())
+
+    washcookies.open_report()
+    try:
+        washer.wash_all()
+        while True:
+            changed = collect(watcher, opts.debounce, opts.max_delay)
+            if changed:
+                washer.handle(changed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        washcookies.close_report()
+        washer.stats.report()
+    return 0
+
+
+if __name__ == "__main__":
+    res = main(sys.argv[1:])
+    sys.exit(res)
+
+__all__ = (
+    "InotifyWatcher",
+    "PollWatcher",
+    "Washer",
+    "main",
+)
+
+# Here there be dragons
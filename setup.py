@@ -31,8 +31,8 @@ that is not matched by some rule is discarded.""",
         'Environment :: Console', 'Topic :: Utilities',
         'Topic :: Text Processing'
     ],
-    py_modules=['cookies'],
-    scripts=['washcookies.py'],
+    py_modules=['cookies', 'washpipe', 'washpreview'],
+    scripts=['washcookies.py', 'cookiewatch.py', 'cookiescan.py'],
 )
 
 # Here there be dragons
@@ -62,7 +62,7 @@ from __future__ import with_statement, print_function
 
 __version__ = "1.2.1"
 
-import os, plistlib, pwd, re, sys, tempfile
+import json, os, plistlib, pwd, re, sys, tempfile
 import cookies
 
 # Regular expression matching a rule in ~/.cookierc
@@ -103,22 +103,28 @@ def unparse_rule(r, flag='-', sep=' '):
     return sep.join(out)
 
 
+def cookie_field(cookie, key):
+    """Look up the field named by key (a lower-case string) in the cookie,
+    ignoring case.  Returns a tuple (exists, value), where value is '' if the
+    cookie has no such field.
+    """
+    if isinstance(cookie, cookies.Cookie):
+        return cookie.lookup(key)
+    for k, v in cookie.items():
+        if key == k.lower():
+            return True, v
+    return False, ''
+
+
 def match_rule(cookie, rule):
-    """Returns True if the specified cookie (a dict) matches the given list of
-    rule criteria; otherwise False.
+    """Returns True if the specified cookie (a dict or Cookie) matches the
+    given list of rule criteria; otherwise False.
     """
     def match_one(op, key, arg):
         neg = op.startswith('!')
         if neg: op = op[1:]
 
-        exists = True
-        for k, v in cookie.items():
-            if key == k.lower():
-                val = v
-                break
-        else:
-            val = ''
-            exists = False
+        exists, val = cookie_field(cookie, key)
 
         if op == '~':
             res = bool(re.compile(arg).search(val))
@@ -140,34 +146,127 @@ def match_rule(cookie, rule):
         return True
 
 
-def load_rules(user=None):
+def is_exact_rule(rule):
+    """Returns True if the rule consists of a single case-insensitive equality
+    test, either "key=arg" or "@arg" without a leading period.  Such rules can
+    be checked by a hash lookup on the lower-cased value of the key.
+    """
+    if len(rule) != 1:
+        return False
+    op, key, arg = rule[0]
+    return op == '=' or (op == '@' and not arg.startswith('.'))
+
+
+class RuleSet(object):
+    """An ordered collection of rules.
+
+    Exact rules (see is_exact_rule) are moved into one table per field, mapping
+    the lower-cased argument to the earliest such rule, so that a large list of
+    them costs one lookup per field rather than one comparison per rule.  The
+    remaining rules are checked in order with match_rule.  A RuleSet reports
+    the same first matching rule as a linear scan of its rules would.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+        self.exact = {}  # key -> {lower-case arg: (pos, rule)}
+        self.other = []  # [(pos, rule)]
+        for pos, rule in enumerate(self.rules):
+            if is_exact_rule(rule):
+                op, key, arg = rule[0]
+                tab = self.exact.setdefault(key, {})
+                tab.setdefault(arg.lower(), (pos, rule))
+            else:
+                self.other.append((pos, rule))
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def scan(self, cookie):
+        """Return the first rule matching the cookie by a linear scan, or
+        None if no rule matches.
+        """
+        for rule in self.rules:
+            if match_rule(cookie, rule):
+                return rule
+        return None
+
+    def first_match(self, cookie):
+        """Return the first rule matching the cookie, or None if no rule
+        matches.
+        """
+        best = None
+        for key, tab in self.exact.items():
+            exists, val = cookie_field(cookie, key)
+            try:
+                hit = tab.get(val.lower())
+            except (AttributeError, TypeError):
+                # Not a string; let match_rule decide what happens.
+                return self.scan(cookie)
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+
+        limit = best[0] if best is not None else len(self.rules)
+        for pos, rule in self.other:
+            if pos >= limit:
+                break
+            if match_rule(cookie, rule):
+                return rule
+
+        return best[1] if best is not None else None
+
+
+def rules_path(user=None):
+    """Return the path of the ".cookierc" file in the home directory of the
+    specified user, or of the current user.
+    """
+    return os.path.expanduser('~%s/.cookierc' % (user or ''))
+
+
+def read_rules(cpath):
+    """Read the list of cookie rules from the file at cpath.  Returns a tuple
+    of (a, r, k), where a is a RuleSet of accept rules, r is a RuleSet of
+    reject rules, and k is a RuleSet of keep rules.
+
+    Raises IOError if the file cannot be read, or ValueError if a rule is
+    malformed.
+    """
+    with open(cpath, 'rt') as fp:
+        a = []
+        r = []
+        k = []
+        for line in fp:
+            if line.isspace() or line.startswith('#'):
+                continue
+
+            f, rs = parse_rule(line.strip())
+            if f == '+':
+                a.append(rs)
+            elif f == '-':
+                r.append(rs)
+            elif f == '!':
+                k.append(rs)
+
+        return RuleSet(a), RuleSet(r), RuleSet(k)
+
+
+def load_rules(user=None, cpath=None):
     """Load the list of cookie rules from ".cookierc" in the user's home
-    directory.  Returns a tuple of (a, r, k), where a is a list of accept
-    rules, r is a list of reject rules, and k is a list of keep rules.
+    directory, or from cpath if it is given.  Returns a tuple of (a, r, k) as
+    for read_rules.
 
     If no rules are found, the default is to accept all cookies.
     """
-    cpath = os.path.expanduser('~%s/.cookierc' % (user or ''))
+    if cpath is None:
+        cpath = rules_path(user)
     try:
-        with open(cpath, 'rt') as fp:
-            a = []
-            r = []
-            k = []
-            for line in fp:
-                if line.isspace() or line.startswith('#'):
-                    continue
-
-                f, rs = parse_rule(line.strip())
-                if f == '+':
-                    a.append(rs)
-                elif f == '-':
-                    r.append(rs)
-                elif f == '!':
-                    k.append(rs)
-
-            return a, r, k
+        return read_rules(cpath)
     except (OSError, IOError) as e:
-        return ([parse_rule('+ .')], [])
+        # A rule with no criteria matches every cookie.
+        return RuleSet([[]]), RuleSet(), RuleSet()
 
 
 def find_bad_cookies(cookies, allow, deny, keep):
@@ -178,37 +277,144 @@ def find_bad_cookies(cookies, allow, deny, keep):
     The kill set is a dictionary mapping cookie positions to reasons.  A reason
     is either None, meaning no rule selected this cookie for preservation, or a
     rule, meaning the cookie was rejected by the application of that rule.
+
+    The rule lists may be RuleSets or plain lists of rules.
     """
+    allow, deny, keep = (rs if isinstance(rs, RuleSet) else RuleSet(rs)
+                         for rs in (allow, deny, keep))
 
     kill = {}
     for pos, cookie in enumerate(cookies):
-        for rule in keep:
-            if match_rule(cookie, rule):
-                break
-        else:
-            for rule in deny:
-                if match_rule(cookie, rule):
-                    kill[pos] = rule
-                    break
-            else:
-                for rule in allow:
-                    if match_rule(cookie, rule):
-                        break
-                else:
-                    kill[pos] = None
+        if keep.first_match(cookie) is not None:
+            continue
+
+        rule = deny.first_match(cookie)
+        if rule is not None:
+            kill[pos] = rule
+        elif allow.first_match(cookie) is None:
+            kill[pos] = None
 
     return kill
 
 
-def summarize_changes(cookies, icky, path, ofp=sys.stderr):
+# Cache of unparsed rule text, mapping (id(rule), flag) to (rule, text).  The
+# rule is kept so that its id is not reused while the entry exists.
+rule_text_cache = {}
+
+
+def rule_text(rule, flag='-'):
+    """Return unparse_rule(rule, flag), computing it only once per rule."""
+    key = (id(rule), flag)
+    hit = rule_text_cache.get(key)
+    if hit is None:
+        hit = rule_text_cache[key] = (rule, unparse_rule(rule, flag=flag))
+    return hit[1]
+
+
+def group_changes(cookies, icky, nsample=3):
+    """Group the unwanted cookies by domain and by the rule that rejected them.
+    Returns a list of tuples (domain, reason, count, samples) ordered by
+    domain, where samples lists the names of up to nsample of the cookies.
+    """
+    groups = {}
+    for pos, reason in icky.items():
+        ck = cookies[pos]
+        key = (ck['Domain'], id(reason))
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = [ck['Domain'], reason, 0, []]
+        g[2] += 1
+        if len(g[3]) < nsample:
+            g[3].append(ck['Name'])
+
+    return sorted((tuple(g) for g in groups.values()),
+                  key=lambda g: (g[0], rule_text(g[1]) if g[1] else ''))
+
+
+class ReportWriter(object):
+    """Writes grouped changes (see group_changes) to a file as JSON lines, or
+    as CSV if fmt is "csv".  Each record gives the store path, the domain, the
+    text of the rejecting rule (empty if no rule kept the cookie), the number
+    of cookies, and sample cookie names.
+    """
+
+    def __init__(self, ofp, fmt='jsonl'):
+        self.ofp = ofp
+        self.fmt = fmt
+        if fmt == 'csv':
+            import csv
+            self.csv = csv.writer(ofp)
+            self.csv.writerow(('store', 'domain', 'rule', 'count', 'samples'))
+
+    def write(self, path, groups):
+        for domain, reason, count, samples in groups:
+            text = rule_text(reason) if reason else ''
+            if self.fmt == 'csv':
+                self.csv.writerow(
+                    (path, domain, text, count, ' '.join(samples)))
+            else:
+                self.ofp.write(json.dumps({
+                    'store': path,
+                    'domain': domain,
+                    'rule': text,
+                    'count': count,
+                    'samples': samples,
+                }, default=str) + '\n')
+
+    def close(self):
+        self.ofp.close()
+
+
+# The report writer used by summarize_changes, if any; see open_report.
+report = None
+
+
+def open_report():
+    """Open the report file named by WC_REPORT, if set, for summarize_changes.
+    The format is CSV if WC_REPORT_FORMAT is "csv" or the file name ends in
+    ".csv"; otherwise JSON lines.
+    """
+    global report
+    rpath = os.getenv('WC_REPORT')
+    if not rpath:
+        return
+    fmt = os.getenv('WC_REPORT_FORMAT', '')
+    if not fmt:
+        fmt = 'csv' if rpath.endswith('.csv') else 'jsonl'
+    if fmt == 'csv':
+        # The csv module writes its own line endings, so the file must not
+        # translate them.
+        try:
+            ofp = open(rpath, 'wt', newline='')
+        except TypeError:  # Python 2
+            ofp = open(rpath, 'wb')
+    else:
+        ofp = open(rpath, 'wt')
+    report = ReportWriter(ofp, fmt)
+
+
+def close_report():
+    global report
+    if report is not None:
+        report.close()
+        report = None
+
+
+def summarize_changes(cookies, icky, path, ofp=sys.stderr, writer=None):
     """Print a human-readable description of what is going to be deleted to the
-    specified file handle.
+    specified file handle.  If a report writer is given or a report is open,
+    the changes are also written to it, grouped by domain and rule.
 
     cookies -- the list of cookie dictionaries.
     icky    -- dictionary mapping offsets to reasons.
     path    -- the file being edited.
+    writer  -- the ReportWriter to use (default: the open report, if any).
+
+    If WC_GROUP is set, one line is printed per domain and rule rather than
+    one line per cookie.
     """
     explain = os.getenv('WC_EXPLAIN', False)
+    grouped = os.getenv('WC_GROUP', False)
 
     print("In '%s'" % path, file=ofp)
     if not icky:
@@ -218,6 +424,27 @@ def summarize_changes(cookies, icky, path, ofp=sys.stderr):
     print("Removing %d unwanted cookie%s:" %
           (len(icky), "s" if len(icky) != 1 else ""),
           file=ofp)
+    if writer is None:
+        writer = report
+    groups = None
+    if grouped or writer is not None:
+        groups = group_changes(cookies, icky)
+        if writer is not None:
+            writer.write(path, groups)
+
+    if grouped:
+        for domain, reason, count, samples in groups:
+            tag = u' \N{black square} ' if reason else u' \N{white square} '
+            print(tag + u'%-30.30s %5d  %s' %
+                  (domain, count, ' '.join(samples)),
+                  file=ofp)
+            if explain and reason:
+                print('   %s' % rule_text(reason, flag='rejected by'),
+                      file=ofp)
+            elif explain:
+                print('   no matching rule', file=ofp)
+        return
+
     for pos in sorted(icky, key=lambda p: cookies[p]['Domain']):
         reason = icky[pos]
         tag = u' \N{black square} ' if reason else u' \N{white square} '
@@ -226,8 +453,7 @@ def summarize_changes(cookies, icky, path, ofp=sys.stderr):
                cookies[pos]['Value']),
               file=ofp)
         if explain and reason:
-            print('   %s' % \
-                  unparse_rule(reason, flag = 'rejected by'), file=ofp)
+            print('   %s' % rule_text(reason, flag='rejected by'), file=ofp)
         elif explain:
             print('   no matching rule', file=ofp)
 
@@ -276,27 +502,77 @@ def process_binary_cookies(allowed, denied, kept):
               file=sys.stderr)
 
 
+def open_google_cookies(cfpath):
+    """Open the Google Chrome cookie database at cfpath.  The busy timeout in
+    seconds may be set with WC_BUSY_TIMEOUT; setting WC_SNAPSHOT causes the
+    cookies to be read from a snapshot copy of the database.
+    """
+    try:
+        timeout = float(os.getenv('WC_BUSY_TIMEOUT', ''))
+    except ValueError:
+        timeout = 5.0
+    return cookies.GoogleCookieDB(cfpath,
+                                  timeout=timeout,
+                                  snapshot=bool(os.getenv('WC_SNAPSHOT')))
+
+
 def process_google_cookies(allowed, denied, kept):
     """Process cookies for Google Chrome."""
     global dry_run
     cfpath = cookies.get_google_cookie_path()
     try:
-        cdb = cookies.read_google_cookies(cfpath)
+        store = open_google_cookies(cfpath)
     except IOError:
         return  # No cookies found, skip the rest.
 
-    icky = find_bad_cookies(cdb, allowed, denied, kept)
-    kills = list(cdb[p] for p in sorted(icky))
-    nkept = len(cdb) - len(kills)
-    summarize_changes(cdb, icky, cfpath)
+    with store:
+        cdb = store.read()
+        icky = find_bad_cookies(cdb, allowed, denied, kept)
+        kills = list(cdb[p] for p in sorted(icky))
+        nkept = len(cdb) - len(kills)
+        summarize_changes(cdb, icky, cfpath)
 
-    if dry_run:
-        print("(skipping write)", file=sys.stderr)
-    else:
-        if kills:
-            cookies.delete_google_cookies(kills, cfpath)
-        print("Kept %d cookie%s." % (nkept, "s" if nkept != 1 else ""),
-              file=sys.stderr)
+        if dry_run:
+            print("(skipping write)", file=sys.stderr)
+        else:
+            if kills:
+                store.delete(kills)
+                compact_google_cookies(store)
+            print("Kept %d cookie%s." % (nkept, "s" if nkept != 1 else ""),
+                  file=sys.stderr)
+        if os.getenv('WC_EXPLAIN') or store.lock_wait >= 0.01:
+            print("Waited %.3f sec for database locks." % store.lock_wait,
+                  file=sys.stderr)
+
+
+def compact_google_cookies(store):
+    """Compact the Google Chrome cookie database after a delete, if requested
+    by setting WC_COMPACT.  If WC_COMPACT is a number strictly between 0 and 1,
+    it gives the fraction of free pages above which the database is vacuumed;
+    any other non-empty value uses the default.
+    """
+    opt = os.getenv('WC_COMPACT', '')
+    if not opt:
+        return
+    threshold = 0.25
+    try:
+        if 0 < float(opt) < 1:
+            threshold = float(opt)
+    except ValueError:
+        pass
+
+    try:
+        res = store.compact(threshold)
+    except cookies.sql.Error as e:
+        print("Compaction failed: %s" % e, file=sys.stderr)
+        return
+    if res is None:
+        print("No compaction needed.", file=sys.stderr)
+        return
+    saved, elapsed = res
+    print("Compacted: reclaimed %d byte%s in %.3f sec." %
+          (saved, "s" if saved != 1 else "", elapsed),
+          file=sys.stderr)
 
 
 def main(argv):
@@ -304,9 +580,33 @@ def main(argv):
     global dry_run
     dry_run = os.getenv('WC_DRY_RUN', False)
     allowed, denied, kept = load_rules()
-    process_apple_cookies(allowed, denied, kept)
-    process_binary_cookies(allowed, denied, kept)
-    process_google_cookies(allowed, denied, kept)
+    old_rules = os.getenv('WC_PREVIEW')
+    if old_rules:
+        import washpreview
+        try:
+            old = read_rules(old_rules)
+        except (IOError, OSError, ValueError) as e:
+            print("Unable to read old rules from '%s': %s" % (old_rules, e),
+                  file=sys.stderr)
+            return 1
+        washpreview.preview(old, (allowed, denied, kept),
+                            washpreview.cached_snapshot())
+        return 0
+
+    open_report()
+    try:
+        if os.getenv('WC_ASYNC'):
+            import washpipe
+            # Pass the report explicitly: when this file is run as a script,
+            # washpipe sees a separate copy of this module.
+            washpipe.wash(allowed, denied, kept, dry_run, writer=report)
+            return 0
+
+        process_apple_cookies(allowed, denied, kept)
+        process_binary_cookies(allowed, denied, kept)
+        process_google_cookies(allowed, denied, kept)
+    finally:
+        close_report()
     return 0
 
 
@@ -318,6 +618,7 @@ __all__ = (
     "parse_rule",
     "match_rule",
     "load_rules",
+    "RuleSet",
     "cookie_path",
     "read_cookies",
     "write_cookies",
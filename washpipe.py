@@ -0,0 +1,246 @@
+##
+## Name:     washpipe.py
+## Purpose:  Wash cookie stores with overlapping read, classify, and write.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## The process_*_cookies functions in washcookies.py read a whole store, then
+## classify it, then write it.  This module runs each store as a pipeline of
+## three stages connected by bounded queues:
+##
+##   read -> classify -> write
+##
+## The read and write stages do their I/O on a worker thread belonging to the
+## store, while the classify stage applies find_bad_cookies on the event loop.
+## All the stores are washed concurrently, so the time taken is closer to the
+## larger of the I/O and CPU costs than to their sum.  A full queue blocks the
+## stage that feeds it, so no stage can run far ahead of the others.
+##
+## Chrome cookies are read and deleted in batches.  The plist and binarycookies
+## formats can only be read and written as a whole, so those stores are read
+## in one step, classified in batches, and written back once at the end.
+##
+from __future__ import print_function
+
+import asyncio, os, sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cookies, washcookies
+
+# Default number of cookies per batch.
+batch_size = 1000
+
+# Default number of batches that may wait in each queue.
+queue_depth = 4
+
+
+class GoogleSource(object):
+    """Pipeline adapter for the Google Chrome cookie database.  All methods
+    must be called on the same thread.
+    """
+
+    def __init__(self, path, size=batch_size):
+        self.path = path
+        self.size = size
+        self.store = None
+        self.last = None
+        self.deleted = False
+
+    def open(self):
+        self.store = washcookies.open_google_cookies(self.path)
+
+    def next_batch(self):
+        batch = self.store.read_batch(self.last, self.size)
+        if batch:
+            self.last = batch[-1]['creation_utc']
+        return batch
+
+    def delete(self, kills):
+        self.store.delete(kills)
+        self.deleted = True
+
+    def finish(self, kept, changed):
+        if self.deleted:
+            washcookies.compact_google_cookies(self.store)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def report(self, ofp=sys.stderr):
+        if os.getenv('WC_EXPLAIN') or self.store.lock_wait >= 0.01:
+            print("Waited %.3f sec for database locks." % self.store.lock_wait,
+                  file=ofp)
+
+
+class FileSource(object):
+    """Pipeline adapter for a cookie store that is read and written as a whole
+    file, using the given read(path) and write(cookies, path) functions.
+    """
+
+    def __init__(self, path, read, write, size=batch_size):
+        self.path = path
+        self.read = read
+        self.write = write
+        self.size = size
+        self.cookies = None
+        self.pos = 0
+
+    def open(self):
+        self.cookies = self.read(self.path)
+
+    def next_batch(self):
+        batch = self.cookies[self.pos:self.pos + self.size]
+        self.pos += len(batch)
+        return batch
+
+    def delete(self, kills):
+        pass  # the survivors are written by finish
+
+    def finish(self, kept, changed):
+        if changed:
+            self.write(kept, self.path)
+
+    def close(self):
+        self.cookies = None
+
+    def report(self, ofp=sys.stderr):
+        pass
+
+
+def default_sources():
+    """Return a list of pipeline sources for the current user's stores."""
+    return [
+        FileSource(cookies.get_apple_cookie_path(),
+                   cookies.read_apple_cookies, cookies.write_apple_cookies),
+        FileSource(cookies.get_apple_bincookie_path(),
+                   cookies.read_binary_cookies, cookies.write_binary_cookies),
+        GoogleSource(cookies.get_google_cookie_path()),
+    ]
+
+
+async def read_stage(loop, pool, src, out):
+    """Read batches from src on pool and put them on the out queue, followed
+    by None at the end.
+    """
+    while True:
+        batch = await loop.run_in_executor(pool, src.next_batch)
+        if not batch:
+            break
+        await out.put(batch)
+    await out.put(None)
+
+
+async def classify_stage(inq, out, allowed, denied, kept):
+    """Classify batches from the inq queue and put pairs (batch, icky) on the
+    out queue, followed by None at the end.  Positions in icky are relative
+    to the batch.
+    """
+    while True:
+        batch = await inq.get()
+        if batch is None:
+            break
+        icky = washcookies.find_bad_cookies(batch, allowed, denied, kept)
+        await out.put((batch, icky))
+    await out.put(None)
+
+
+async def write_stage(loop, pool, src, inq, dry_run):
+    """Delete the unwanted cookies from each batch on the inq queue.  Returns
+    a tuple (cdb, icky) of all the cookies seen and the positions of the
+    unwanted ones, as for summarize_changes.
+    """
+    cdb, icky = [], {}
+    while True:
+        item = await inq.get()
+        if item is None:
+            break
+        batch, bad = item
+        for pos, reason in bad.items():
+            icky[pos + len(cdb)] = reason
+        cdb.extend(batch)
+        if bad and not dry_run:
+            kills = list(batch[p] for p in sorted(bad))
+            await loop.run_in_executor(pool, src.delete, kills)
+
+    return cdb, icky
+
+
+async def gather_or_cancel(*coros):
+    """Run the coroutines concurrently and return their results.  If any of
+    them fails, the rest are cancelled, and have finished (running their
+    cleanup) before the error is propagated.
+    """
+    tasks = list(asyncio.ensure_future(c) for c in coros)
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def wash_source(src, allowed, denied, kept, dry_run, writer=None,
+                      depth=queue_depth):
+    """Wash one cookie store through a read/classify/write pipeline.  The
+    changes are written to writer, if it is not None, as summarize_changes
+    does.
+    """
+    loop = asyncio.get_event_loop()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        try:
+            await loop.run_in_executor(pool, src.open)
+        except (IOError, NotImplementedError):
+            return  # No cookies found, skip the rest.
+
+        try:
+            read_q = asyncio.Queue(depth)
+            kill_q = asyncio.Queue(depth)
+            _, _, (cdb, icky) = await gather_or_cancel(
+                read_stage(loop, pool, src, read_q),
+                classify_stage(read_q, kill_q, allowed, denied, kept),
+                write_stage(loop, pool, src, kill_q, dry_run))
+
+            washcookies.summarize_changes(cdb, icky, src.path, writer=writer)
+            if dry_run:
+                print("(skipping write)", file=sys.stderr)
+            else:
+                survivors = list(c for p, c in enumerate(cdb) if p not in icky)
+                await loop.run_in_executor(pool, src.finish, survivors,
+                                           bool(icky))
+                nkept = len(survivors)
+                print("Kept %d cookie%s." % (nkept, "s" if nkept != 1 else ""),
+                      file=sys.stderr)
+            src.report()
+        finally:
+            await loop.run_in_executor(pool, src.close)
+
+
+async def wash_sources(sources, allowed, denied, kept, dry_run, writer=None):
+    """Wash all the given cookie stores concurrently."""
+    await gather_or_cancel(*(wash_source(src, allowed, denied, kept, dry_run,
+                                         writer) for src in sources))
+
+
+def wash(allowed, denied, kept, dry_run, sources=None, writer=None):
+    """Wash the current user's cookie stores (or the given sources) using
+    concurrent pipelines.  This is the pipelined equivalent of calling each
+    of the process_*_cookies functions in washcookies.  If writer is given,
+    it is the ReportWriter to which the changes are reported.
+    """
+    if sources is None:
+        sources = default_sources()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            wash_sources(sources, allowed, denied, kept, dry_run, writer))
+    finally:
+        loop.close()
+
+
+__all__ = (
+    "GoogleSource",
+    "FileSource",
+    "wash",
+)
+
+# Here there be dragons
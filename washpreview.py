@@ -0,0 +1,283 @@
+##
+## Name:     washpreview.py
+## Purpose:  Preview the effect of a change to the cookie rules.
+## Author:   M. J. Fromberger <http://spinning-yarns.org/michael/>
+##
+## Given an old and a new set of rules, this module reports which cookies
+## would change verdict (kept or removed) under the new rules.  The cookies are
+## taken from a snapshot of the stores that is cached on disk and refreshed
+## only when a store has changed since the snapshot was taken.
+##
+## A cookie can only change verdict if it matches a rule that was added or
+## removed, since otherwise the same keep, deny, and allow rules match it under
+## both rule sets.  So only the cookies that match a changed rule are checked
+## again.  Changed rules that test a single field for equality are looked up in
+## an index of the snapshot by field value; the rest are matched by a scan.
+##
+from __future__ import print_function
+
+import json, os, sys, tempfile
+from datetime import datetime
+
+import cookies, washcookies
+
+# Types of field values that are kept in a snapshot.
+try:
+    snapshot_types = (str, unicode, int, long, float, bool, datetime)
+except NameError:
+    snapshot_types = (str, int, float, bool, datetime)
+
+# The version of the saved snapshot format.  A saved snapshot of another
+# version is not loaded.
+snapshot_version = 2
+
+# The format of times in a saved snapshot.  Each time is saved as an object
+# {"time": text}, which cannot be confused with any other value.
+time_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def save_value(v):
+    """Return the JSON form of a field value for a saved snapshot."""
+    if isinstance(v, datetime):
+        return {'time': v.strftime(time_format)}
+    return v
+
+
+def load_value(v):
+    """Return the field value whose JSON form in a saved snapshot is v."""
+    if isinstance(v, dict):
+        return datetime.strptime(v['time'], time_format)
+    return v
+
+
+def snapshot_path(user=None):
+    """Return the path of the cached store snapshot for the specified user, or
+    for the current user.
+    """
+    return washcookies.rules_path(user) + '.snapshot'
+
+
+def default_stores():
+    """Return a list of (path, read) pairs for the current user's stores."""
+    return [
+        (cookies.get_apple_cookie_path(), cookies.read_apple_cookies),
+        (cookies.get_apple_bincookie_path(), cookies.read_binary_cookies),
+        (cookies.get_google_cookie_path(), cookies.read_google_cookies),
+    ]
+
+
+def store_mtime(path):
+    """Return the latest modification time of the store at path, including
+    its SQLite journal or write-ahead log, or None if it does not exist.
+    """
+    ts = []
+    for p in (path, path + '-journal', path + '-wal'):
+        try:
+            ts.append(os.path.getmtime(p))
+        except OSError:
+            pass
+    return max(ts) if ts else None
+
+
+class Snapshot(object):
+    """A snapshot of the cookies in a set of stores, holding only the fields
+    whose values are strings, numbers, booleans, or times.  The cookies of each
+    store are in self.stores, a dictionary mapping the store path to a list
+    of Cookie records.
+    """
+
+    def __init__(self, stores=None):
+        self.stores = stores or {}
+        self.index = {}  # key -> {lower-case value: [(path, pos)]}
+
+    @classmethod
+    def read(cls, sources):
+        """Take a snapshot of the stores given as (path, read) pairs."""
+        stores = {}
+        for path, read in sources:
+            try:
+                cdb = read(path)
+            except (IOError, NotImplementedError):
+                continue
+            stores[path] = list(
+                cookies.Cookie((k, v) for k, v in c.items()
+                               if isinstance(v, snapshot_types)) for c in cdb)
+        return cls(stores)
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot saved by save."""
+        with open(path, 'rt') as fp:
+            data = json.load(fp)
+        if not isinstance(data, dict) or \
+           data.get('version') != snapshot_version:
+            raise ValueError("unsupported snapshot format in '%s'" % path)
+        stores = {}
+        for spath, st in data['stores'].items():
+            keys = st['fields']
+            stores[spath] = list(
+                cookies.Cookie((k, load_value(v))
+                               for k, v in zip(keys, row) if v is not None)
+                for row in st['rows'])
+        return cls(stores)
+
+    def save(self, path):
+        """Save the snapshot to path.  Each store is written as a list of
+        field names and a list of rows, with null for missing fields.  Since
+        the snapshot holds cookie values, the file is readable only by its
+        owner, and it is replaced atomically.
+        """
+        stores = {}
+        for spath, cdb in self.stores.items():
+            keys = sorted(set(k for c in cdb for k in c.keys()))
+            stores[spath] = {
+                'fields': keys,
+                'rows': list(list(save_value(c.get(k)) for k in keys)
+                             for c in cdb),
+            }
+        data = {'version': snapshot_version, 'stores': stores}
+
+        # mkstemp creates the file with mode 0600.
+        fd, name = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    text=True)
+        try:
+            with os.fdopen(fd, 'wt') as fp:
+                json.dump(data, fp, separators=(',', ':'))
+            os.rename(name, path)
+        except:
+            os.unlink(name)
+            raise
+
+    def lookup(self, key, arg):
+        """Return the (path, pos) of each cookie whose field named by key is
+        equal to arg, ignoring case.
+        """
+        tab = self.index.get(key)
+        if tab is None:
+            tab = self.index[key] = {}
+            for spath, cdb in self.stores.items():
+                for pos, c in enumerate(cdb):
+                    exists, val = c.lookup(key)
+                    try:
+                        lv = val.lower()
+                    except AttributeError:
+                        continue
+                    tab.setdefault(lv, []).append((spath, pos))
+        return tab.get(arg.lower(), ())
+
+
+def cached_snapshot(spath=None, sources=None):
+    """Return a snapshot of the stores, loaded from the file at spath if it is
+    newer than all the stores, or else taken afresh and saved there.
+    """
+    spath = spath or snapshot_path()
+    if sources is None:
+        sources = default_stores()
+    try:
+        taken = os.path.getmtime(spath)
+        if all((store_mtime(p) or 0) <= taken for p, _ in sources):
+            return Snapshot.load(spath)
+    except (OSError, IOError, ValueError, KeyError):
+        pass
+
+    snap = Snapshot.read(sources)
+    try:
+        snap.save(spath)
+    except (OSError, IOError) as e:
+        print("Unable to save snapshot: %s" % e, file=sys.stderr)
+    return snap
+
+
+def diff_rules(old, new):
+    """Compare two rule sets, each a tuple (allow, deny, keep) as returned by
+    load_rules.  Returns a list of (flag, change, rule) tuples, where flag is
+    the rule type and change is '+' for added or '-' for removed rules.
+    """
+    out = []
+    for flag, ors, nrs in zip('+-!', old, new):
+        ot = list(washcookies.unparse_rule(r) for r in ors)
+        nt = list(washcookies.unparse_rule(r) for r in nrs)
+        out.extend((flag, '-', r) for r, t in zip(ors, ot) if t not in nt)
+        out.extend((flag, '+', r) for r, t in zip(nrs, nt) if t not in ot)
+    return out
+
+
+def affected(snap, changed):
+    """Return the (path, pos) of each cookie in the snapshot that matches at
+    least one of the changed rules.
+    """
+    found = set()
+    scan = []
+    for rule in changed:
+        if washcookies.is_exact_rule(rule):
+            op, key, arg = rule[0]
+            found.update(snap.lookup(key, arg))
+        else:
+            scan.append(rule)
+
+    if scan:
+        rs = washcookies.RuleSet(scan)
+        for spath, cdb in snap.stores.items():
+            for pos, c in enumerate(cdb):
+                if (spath, pos) not in found and rs.first_match(c) is not None:
+                    found.add((spath, pos))
+    return found
+
+
+def preview(old, new, snap, ofp=sys.stderr):
+    """Print the cookies in the snapshot whose verdict differs between the old
+    and new rule sets.  Returns the number of cookies that changed verdict.
+    """
+    changes = diff_rules(old, new)
+    if not changes:
+        print("No rule changes.", file=ofp)
+        return 0
+    for flag, change, rule in changes:
+        print("%-8s %s" % ('added' if change == '+' else 'removed',
+                            washcookies.rule_text(rule, flag)),
+              file=ofp)
+
+    cands = {}
+    for spath, pos in affected(snap, list(r for _, _, r in changes)):
+        cands.setdefault(spath, []).append(pos)
+
+    total = 0
+    for spath in sorted(cands):
+        cdb = list(snap.stores[spath][p] for p in sorted(cands[spath]))
+        was = washcookies.find_bad_cookies(cdb, *old)
+        now = washcookies.find_bad_cookies(cdb, *new)
+        flips = list(p for p in range(len(cdb)) if (p in was) != (p in now))
+        if not flips:
+            continue
+
+        total += len(flips)
+        print("In '%s' (%d cookie%s checked)" %
+              (spath, len(cdb), "s" if len(cdb) != 1 else ""),
+              file=ofp)
+        for p in sorted(flips, key=lambda p: cdb[p].get('Domain', '')):
+            ck = cdb[p]
+            verdict = 'now removed' if p in now else 'now kept'
+            print(u'   %-12s %-30.30s %s=%-20.20s' %
+                  (verdict, ck.get('Domain', ''), ck.get('Name', ''),
+                   ck.get('Value', '')),
+                  file=ofp)
+            reason = now.get(p) or was.get(p)
+            if reason:
+                print('      %s' %
+                      washcookies.rule_text(reason, 'rejected by'),
+                      file=ofp)
+
+    print("%d cookie%s would change verdict." %
+          (total, "s" if total != 1 else ""),
+          file=ofp)
+    return total
+
+
+__all__ = (
+    "Snapshot",
+    "cached_snapshot",
+    "diff_rules",
+    "preview",
+)
+
+# Here there be dragons